@@ -1,66 +1,452 @@
 """Telegram bot integrating with OpenWebUI LLM API."""
 
 import os
-import json
-import time
+import queue
+import atexit
 import asyncio
+import random
+import hashlib
 import logging
+import logging.handlers
 
+from array import array
 from pathlib import Path
+from dataclasses import dataclass
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+import aiohttp
+import orjson
+import redis.asyncio as redis
+from aiohttp import web
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
+from telebot import types
 from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException, session_manager
 
-# Configure logging
-# Create logs directory if it doesn't exist
 root_dir = Path(__file__).resolve().parent
-logs_dir = root_dir / 'logs'
-logs_dir.mkdir(exist_ok=True)
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(logs_dir / "telebot-opwebui.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger("telebot-opwebui")
 
-# Load environment variables from .env file
-load_dotenv(root_dir / 'config' / '.env')
-
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-OPWEBUI_CHAT_ENDPOINT = os.getenv('OPWEBUI_CHAT_ENDPOINT')
-OPWEBUI_JWT_TOKEN = os.getenv('OPWEBUI_JWT_TOKEN')
-OPWEBUI_MODEL = os.getenv('OPWEBUI_MODEL')
-OPWEBUI_COLLECTION_ID = os.getenv('OPWEBUI_COLLECTION_ID')
-
-# Configurable message
-WELCOME_MESSAGE = os.getenv('WELCOME_MESSAGE')
-
-# Validate required environment variables
-missing_vars = []
-if not TELEGRAM_BOT_TOKEN:
-    missing_vars.append('TELEGRAM_BOT_TOKEN')
-if not OPWEBUI_CHAT_ENDPOINT:
-    missing_vars.append('OPWEBUI_CHAT_ENDPOINT')
-if not OPWEBUI_JWT_TOKEN:
-    missing_vars.append('OPWEBUI_JWT_TOKEN')
-if not OPWEBUI_MODEL:
-    missing_vars.append('OPWEBUI_MODEL')
-if not WELCOME_MESSAGE:
-    missing_vars.append('WELCOME_MESSAGE')
-
-if missing_vars:
-    logger.error("Missing required environment variables: %s", ", ".join(missing_vars))
-    exit(1)
-
-bot = AsyncTeleBot(TELEGRAM_BOT_TOKEN)
+
+def setup_logging():
+    """Log to logs/telebot-opwebui.log and the console from a background thread"""
+    # Create logs directory if it doesn't exist
+    logs_dir = root_dir / 'logs'
+    logs_dir.mkdir(exist_ok=True)
+
+    # Records are queued by the calling code and written by a background listener
+    # thread, so file and console I/O never block the event loop
+    log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    log_file_handler = logging.handlers.RotatingFileHandler(
+        logs_dir / "telebot-opwebui.log",
+        maxBytes=10_000_000,
+        backupCount=5,
+        delay=True
+    )
+    log_stream_handler = logging.StreamHandler()
+    log_file_handler.setFormatter(log_formatter)
+    log_stream_handler.setFormatter(log_formatter)
+
+    log_queue = queue.SimpleQueue()
+    log_queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Only merge the message arguments here; the listener's handlers add the full format
+    log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    log_listener = logging.handlers.QueueListener(
+        log_queue,
+        log_file_handler,
+        log_stream_handler,
+        respect_handler_level=True
+    )
+    log_listener.start()
+    # Stopped at exit rather than in main() so records logged during startup and
+    # shutdown are still flushed
+    atexit.register(log_listener.stop)
+
+    logging.basicConfig(level=logging.INFO, handlers=[log_queue_handler])
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Application settings, read and validated once from the environment"""
+    telegram_bot_token: str
+    opwebui_chat_endpoint: str
+    opwebui_jwt_token: str
+    opwebui_model: str
+    welcome_message: str
+    opwebui_collection_id: str | None = None
+    # Optional response caches. The exact-match cache is enabled when redis_url is set,
+    # the semantic cache additionally needs embedding_endpoint.
+    redis_url: str | None = None
+    embedding_endpoint: str | None = None
+    embedding_model: str = 'nomic-embed-text'
+    # Sent as a bearer token to the embedding endpoint, which is usually a separate service
+    embedding_api_key: str | None = None
+    semantic_cache_threshold: float = 0.9
+    cache_ttl: int = 14400
+    # Maximum number of concurrent requests sent to OpenWebUI across all chats
+    llm_concurrency: int = 8
+    # Longer queries are refused before they reach the queue, cache or LLM
+    max_query_chars: int = 2000
+    # Size of the event loop's default thread pool, which runs aiohttp's DNS lookups
+    http_workers: int = 32
+    # Optional webhook mode, used instead of long polling when webhook_url is set
+    webhook_url: str | None = None
+    webhook_secret: str | None = None
+    webhook_host: str = '0.0.0.0'
+    webhook_port: int = 8080
+
+    REQUIRED = (
+        'TELEGRAM_BOT_TOKEN',
+        'OPWEBUI_CHAT_ENDPOINT',
+        'OPWEBUI_JWT_TOKEN',
+        'OPWEBUI_MODEL',
+        'WELCOME_MESSAGE',
+    )
+
+    @classmethod
+    def from_env(cls, env=None) -> "Config":
+        """
+        Build the configuration from environment variables.
+
+        Raises ValueError when required variables are missing or a numeric
+        setting cannot be parsed.
+        """
+        env = os.environ if env is None else env
+        missing_vars = [name for name in cls.REQUIRED if not env.get(name)]
+        if missing_vars:
+            raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
+
+        def number(name, default, convert):
+            value = env.get(name, default)
+            try:
+                return convert(value)
+            except ValueError:
+                raise ValueError(f"Invalid {name}: {value!r}") from None
+
+        return cls(
+            telegram_bot_token=env['TELEGRAM_BOT_TOKEN'],
+            opwebui_chat_endpoint=env['OPWEBUI_CHAT_ENDPOINT'],
+            opwebui_jwt_token=env['OPWEBUI_JWT_TOKEN'],
+            opwebui_model=env['OPWEBUI_MODEL'],
+            welcome_message=env['WELCOME_MESSAGE'],
+            opwebui_collection_id=env.get('OPWEBUI_COLLECTION_ID'),
+            redis_url=env.get('REDIS_URL'),
+            embedding_endpoint=env.get('EMBEDDING_ENDPOINT'),
+            embedding_model=env.get('EMBEDDING_MODEL', 'nomic-embed-text'),
+            embedding_api_key=env.get('EMBEDDING_API_KEY'),
+            semantic_cache_threshold=number('SEMANTIC_CACHE_THRESHOLD', '0.9', float),
+            cache_ttl=number('CACHE_TTL', '14400', int),
+            llm_concurrency=number('LLM_CONCURRENCY', '8', int),
+            max_query_chars=number('MAX_QUERY_CHARS', '2000', int),
+            http_workers=number('HTTP_WORKERS', '32', int),
+            webhook_url=env.get('WEBHOOK_URL'),
+            webhook_secret=env.get('WEBHOOK_SECRET'),
+            webhook_host=env.get('WEBHOOK_HOST', '0.0.0.0'),
+            webhook_port=number('WEBHOOK_PORT', '8080', int),
+        )
+
+    @property
+    def exact_cache_enabled(self) -> bool:
+        """Whether the exact-match response cache is configured"""
+        return bool(self.redis_url)
+
+    @property
+    def semantic_cache_enabled(self) -> bool:
+        """Whether the semantic response cache is configured"""
+        return bool(self.redis_url and self.embedding_endpoint)
+
+
+SEMANTIC_CACHE_INDEX = 'idx:qa'
+
+# Streamed answers get a per-read timeout and a much longer overall cap than plain
+# requests, and connecting is bounded separately so an unreachable host fails fast.
+# The Telegram reply is edited at most once per interval while tokens arrive.
+LLM_TIMEOUT = aiohttp.ClientTimeout(total=30)
+LLM_STREAM_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=10, sock_read=30)
+STREAM_EDIT_INTERVAL = 1.0
+
+# Gateway errors from OpenWebUI are retried with exponential backoff
+LLM_MAX_RETRIES = 2
+LLM_RETRY_BACKOFF = 0.3
+LLM_RETRY_STATUSES = frozenset({502, 503, 504})
+
+# Reply sent when answering a message fails unexpectedly
+_FAIL_REPLY = "Sorry, something went wrong. Please try again later."
+
+# The active configuration and bot, set by build_app()
+CFG = None
+bot = None
+
+# Static parts of the OpenWebUI requests, derived from the configuration once in
+# build_app() instead of per call. Bodies are pre-encoded with orjson, so the
+# content type is a session default. Credentials are not: the session is shared
+# with the embedding endpoint, so each request passes its own auth headers.
+_HEADERS = {"Content-Type": "application/json"}
+_AUTH_HEADERS = None
+_EMBEDDING_HEADERS = None
+_FILES = None
+
+# Hash state for the constant model/collection prefix of exact-match cache keys
+_EXACT_KEY_PREFIX = None
+
+# Shared HTTP session for OpenWebUI requests. It is created lazily because
+# aiohttp binds sessions to the running event loop.
+_session = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the shared OpenWebUI session, creating it on first use"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=32,
+                keepalive_timeout=60,
+                enable_cleanup_closed=True
+            ),
+            timeout=LLM_TIMEOUT,
+            headers=_HEADERS
+        )
+    return _session
+
+
+async def close_session():
+    """Close the shared OpenWebUI session if it is open"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+# Per-chat FIFO queues and their worker tasks. Messages within a chat are handled
+# in order while different chats are processed concurrently.
+CHAT_QUEUE_SIZE = 16
+CHAT_IDLE_TIMEOUT = 60
+CHAT_QUEUES = {}
+CHAT_WORKERS = {}
+
+# Caps concurrent OpenWebUI requests so a burst of chats cannot overload the backend.
+# Sized from the configuration in build_app().
+LLM_SEM = None
+
+# Telegram allows about 30 messages per second overall and 1 per second per chat.
+# Exceeding that returns 429 with a retry_after cool-down.
+TELEGRAM_LIMITER = AsyncLimiter(30, 1)
+CHAT_LIMITERS = {}
+TELEGRAM_MAX_RETRIES = 3
+
+
+async def telegram_send(limit_chat_id, send, *args, **kwargs):
+    """
+    Call a Telegram API method within the global send rate limit.
+
+    When limit_chat_id is given, the per-chat limit is applied as well. Calls
+    rejected with 429 are retried after the advertised retry_after plus jitter.
+    """
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        try:
+            if limit_chat_id is None:
+                async with TELEGRAM_LIMITER:
+                    return await send(*args, **kwargs)
+            chat_limiter = CHAT_LIMITERS.get(limit_chat_id)
+            if chat_limiter is None:
+                chat_limiter = CHAT_LIMITERS[limit_chat_id] = AsyncLimiter(1, 1)
+            # Wait for the chat's slot first, so callers blocked on a busy chat do
+            # not hold global capacity that other chats could use
+            async with chat_limiter:
+                async with TELEGRAM_LIMITER:
+                    return await send(*args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+                raise
+            retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+
+        delay = retry_after + random.uniform(0, 0.5)
+        logger.warning(
+            "Telegram rate limit hit for chat %s, retrying in %.2fs (attempt %d/%d)",
+            limit_chat_id,
+            delay,
+            attempt + 1,
+            TELEGRAM_MAX_RETRIES
+        )
+        await asyncio.sleep(delay)
+
+
+# Shared Redis client for the response cache, created lazily like the HTTP session
+_redis = None
+_semantic_index_ready = False
+
+# Cumulative cache hit/miss counters, logged on every lookup
+CACHE_STATS = Counter()
+
+
+def get_redis() -> redis.Redis:
+    """Return the shared Redis client, creating it on first use"""
+    global _redis
+    if _redis is None:
+        # RESP2 keeps raw FT.SEARCH replies as flat arrays
+        _redis = redis.from_url(CFG.redis_url, protocol=2)
+    return _redis
+
+
+async def close_redis():
+    """Close the shared Redis client if it was created"""
+    global _redis, _semantic_index_ready
+    if _redis is not None:
+        await _redis.aclose()
+    _redis = None
+    _semantic_index_ready = False
+
+
+def preview(text: str, width: int) -> str:
+    """Truncate text for log output"""
+    return text if len(text) <= width else text[:width] + '...'
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query for cache lookups (case and whitespace insensitive)"""
+    return " ".join(query.lower().split())
+
+
+def exact_cache_key(query: str) -> str:
+    """Build the exact-match cache key from the model, collection and normalized query"""
+    digest = _EXACT_KEY_PREFIX.copy()
+    digest.update(normalize_query(query).encode())
+    return "llm:" + digest.hexdigest()
+
+
+async def exact_cache_lookup(query: str, chat_id: int):
+    """Return the cached answer for an identical query, or None on a miss"""
+    try:
+        cached = await get_redis().get(exact_cache_key(query))
+    except redis.RedisError as e:
+        logger.warning("Exact cache unavailable for chat %s: %s", chat_id, e)
+        return None
+
+    if cached is None:
+        CACHE_STATS['exact_miss'] += 1
+        logger.info(
+            "Exact cache MISS for chat %s (hits=%d, misses=%d)",
+            chat_id,
+            CACHE_STATS['exact_hit'],
+            CACHE_STATS['exact_miss']
+        )
+        return None
+
+    CACHE_STATS['exact_hit'] += 1
+    logger.info(
+        "Exact cache HIT for chat %s (hits=%d, misses=%d)",
+        chat_id,
+        CACHE_STATS['exact_hit'],
+        CACHE_STATS['exact_miss']
+    )
+    return cached.decode()
+
+
+async def exact_cache_store(query: str, answer: str, chat_id: int):
+    """Store an answer in the exact-match cache"""
+    try:
+        await get_redis().set(exact_cache_key(query), answer, ex=CFG.cache_ttl)
+    except redis.RedisError as e:
+        logger.warning("Failed to store exact cache entry for chat %s: %s", chat_id, e)
+
+
+async def embed(query: str) -> bytes:
+    """Embed a query via the OpenAI-compatible embedding endpoint as FLOAT32 bytes"""
+    async with get_session().post(
+        CFG.embedding_endpoint,
+        headers=_EMBEDDING_HEADERS,
+        data=orjson.dumps({"model": CFG.embedding_model, "input": query})
+    ) as response:
+        response.raise_for_status()
+        response_json = orjson.loads(await response.read())
+    return array('f', response_json['data'][0]['embedding']).tobytes()
+
+
+async def ensure_semantic_index(dim: int):
+    """Create the RediSearch vector index for cached answers if it does not exist"""
+    global _semantic_index_ready
+    if _semantic_index_ready:
+        return
+    try:
+        await get_redis().execute_command(
+            "FT.CREATE", SEMANTIC_CACHE_INDEX, "ON", "HASH", "PREFIX", "1", "qa:",
+            "SCHEMA",
+            "chat", "TAG",
+            "v", "VECTOR", "HNSW", "6", "TYPE", "FLOAT32", "DIM", dim, "DISTANCE_METRIC", "COSINE"
+        )
+    except redis.ResponseError as e:
+        if "already exists" not in str(e):
+            raise
+    _semantic_index_ready = True
+
+
+async def semantic_cache_lookup(query: str, chat_id: int):
+    """
+    Look up a semantically similar cached answer for this chat.
+
+    Returns a tuple of (embedding, cached answer). The embedding is None when the
+    cache is unavailable, and the answer is None on a miss.
+    """
+    try:
+        vector = await embed(normalize_query(query))
+        await ensure_semantic_index(len(vector) // 4)
+        # Tag values are escaped so negative (group) chat IDs parse correctly
+        chat_tag = str(chat_id).replace("-", "\\-")
+        result = await get_redis().execute_command(
+            "FT.SEARCH", SEMANTIC_CACHE_INDEX,
+            f"(@chat:{{{chat_tag}}})=>[KNN 1 @v $vec AS score]",
+            "PARAMS", "2", "vec", vector,
+            "RETURN", "2", "a", "score",
+            "SORTBY", "score",
+            "LIMIT", "0", "1",
+            "DIALECT", "2"
+        )
+    except (redis.RedisError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, IndexError, ValueError) as e:
+        logger.warning("Semantic cache unavailable for chat %s: %s", chat_id, e)
+        return None, None
+
+    if result and result[0] > 0:
+        fields = dict(zip(result[2][::2], result[2][1::2]))
+        # Cosine distance is 1 - cosine similarity
+        similarity = 1 - float(fields[b'score'])
+        if similarity >= CFG.semantic_cache_threshold:
+            CACHE_STATS['semantic_hit'] += 1
+            logger.info(
+                "Semantic cache HIT for chat %s (similarity %.3f, hits=%d, misses=%d)",
+                chat_id,
+                similarity,
+                CACHE_STATS['semantic_hit'],
+                CACHE_STATS['semantic_miss']
+            )
+            return vector, fields[b'a'].decode()
+
+    CACHE_STATS['semantic_miss'] += 1
+    logger.info(
+        "Semantic cache MISS for chat %s (hits=%d, misses=%d)",
+        chat_id,
+        CACHE_STATS['semantic_hit'],
+        CACHE_STATS['semantic_miss']
+    )
+    return vector, None
+
+
+async def semantic_cache_store(query: str, answer: str, chat_id: int, vector: bytes):
+    """Store an answer in the semantic cache, namespaced by chat"""
+    normalized = normalize_query(query)
+    key = f"qa:{chat_id}:{hashlib.sha256(normalized.encode()).hexdigest()}"
+    try:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"chat": str(chat_id), "q": normalized, "a": answer, "v": vector})
+            pipe.expire(key, CFG.cache_ttl)
+            await pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Failed to store semantic cache entry for chat %s: %s", chat_id, e)
 
 # Handle '/start' and '/help'
-@bot.message_handler(commands=['help', 'start'])
 async def send_welcome(message):
     """Send a welcome message to the user"""
     logger.info(
@@ -69,12 +455,85 @@ async def send_welcome(message):
         message.chat.id
     )
 
-    await bot.reply_to(message, WELCOME_MESSAGE)
+    # Like refusals, welcomes never start a chat worker, so only the global limit applies
+    await telegram_send(None, bot.reply_to, message, CFG.welcome_message)
 
-# Handle all other messages with content_type 'text' (content_types defaults to ['text'])
-@bot.message_handler(func=lambda message: True)
+# Handle all other messages with content_type 'text'
 async def handle_message(message):
-    """Handle all other messages as queries"""
+    """Queue a message on its chat's worker, starting the worker if needed"""
+    chat_id = message.chat.id
+    query = (message.text or "").strip()
+    # Refusals only use the global limit: per-chat limiters are released when a chat
+    # worker goes idle, and a chat that is only ever refused never gets a worker
+    if not query:
+        await telegram_send(None, bot.reply_to, message, "Please send a question.")
+        return
+    if len(query) > CFG.max_query_chars:
+        logger.info(
+            "Rejected message from user %s in chat %s: %d characters exceeds the %d limit",
+            message.from_user.id,
+            chat_id,
+            len(query),
+            CFG.max_query_chars
+        )
+        await telegram_send(
+            None,
+            bot.reply_to,
+            message,
+            f"Query too long. Please keep it under {CFG.max_query_chars} characters."
+        )
+        return
+
+    chat_queue = CHAT_QUEUES.get(chat_id)
+    if chat_queue is None:
+        chat_queue = CHAT_QUEUES[chat_id] = asyncio.Queue(maxsize=CHAT_QUEUE_SIZE)
+
+    # A full backlog is refused rather than waited on: a blocked put could be
+    # overtaken by a newer message once a slot frees up, breaking the chat's order
+    try:
+        chat_queue.put_nowait(message)
+    except asyncio.QueueFull:
+        logger.info(
+            "Rejected message from user %s in chat %s: %d messages already pending",
+            message.from_user.id,
+            chat_id,
+            CHAT_QUEUE_SIZE
+        )
+        await telegram_send(
+            None,
+            bot.reply_to,
+            message,
+            "Too many pending messages. Please wait for the answers before asking more."
+        )
+        return
+
+    if chat_id not in CHAT_WORKERS:
+        CHAT_WORKERS[chat_id] = asyncio.create_task(chat_worker(chat_id, chat_queue))
+
+async def chat_worker(chat_id: int, chat_queue: asyncio.Queue):
+    """Process a chat's queued messages in order, exiting once the chat goes idle"""
+    while True:
+        try:
+            message = await asyncio.wait_for(chat_queue.get(), timeout=CHAT_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # No await between this check and the cleanup, so no message can slip in
+            if chat_queue.empty():
+                del CHAT_QUEUES[chat_id]
+                del CHAT_WORKERS[chat_id]
+                CHAT_LIMITERS.pop(chat_id, None)
+                logger.debug("Worker for chat %s stopped after being idle", chat_id)
+                return
+            continue
+
+        try:
+            await process_message(message)
+        except Exception as e:
+            logger.error("Worker for chat %s failed to process message: %s", chat_id, e)
+        finally:
+            chat_queue.task_done()
+
+async def process_message(message):
+    """Answer a single queued message using the LLM"""
     user_id = message.from_user.id
     query = message.text.strip()
     message_id = message.message_id
@@ -85,134 +544,238 @@ async def handle_message(message):
         user_id,
         chat_id,
         message_id,
-        query[:50] + ('...' if len(query) > 50 else '')
+        preview(query, 50)
     )
-    await bot.send_chat_action(message.chat.id, "typing")
+    # Chat actions are not messages, so only the global limit applies
+    await telegram_send(None, bot.send_chat_action, chat_id, "typing")
 
-    start_time = time.time()
+    # The first streamed update is sent as the reply, later ones edit it in place.
+    # Telegram calls run in a separate task that always sends the latest text, so
+    # rate-limit waits never hold up reading the stream or its LLM_SEM slot.
+    reply = None
+    shown_text = None
+    latest_text = None
+    streaming_done = False
+    text_ready = asyncio.Event()
+
+    async def show_partial_response(text):
+        nonlocal latest_text
+        latest_text = text
+        text_ready.set()
+
+    async def send_partial_responses():
+        nonlocal reply, shown_text
+        while True:
+            await text_ready.wait()
+            text_ready.clear()
+            if streaming_done:
+                return
+            text = latest_text
+            if reply is None:
+                reply = await telegram_send(chat_id, bot.reply_to, message, text)
+            else:
+                await telegram_send(chat_id, bot.edit_message_text, text, chat_id, reply.message_id)
+            shown_text = text
+
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    editor = asyncio.create_task(send_partial_responses())
     try:
-        llm_response = await process_with_llm(query, user_id, chat_id)
-        processing_time = time.time() - start_time
+        llm_response = await process_with_llm(
+            query, user_id, chat_id, on_update=show_partial_response
+        )
+        # Let the editor finish the call in flight, then send the final text here
+        streaming_done = True
+        text_ready.set()
+        await editor
+        processing_time = loop.time() - start_time
 
         logger.info(
             "Successfully processed message from user %s. Processing time: %.2fs. Response: %s",
             user_id,
             processing_time,
-            llm_response[:100] + ('...' if len(llm_response) > 100 else '')
+            preview(llm_response, 100)
         )
-        await bot.reply_to(message, llm_response)
+        if reply is None:
+            await telegram_send(chat_id, bot.reply_to, message, llm_response)
+        elif llm_response != shown_text:
+            # Telegram rejects edits that do not change the text
+            await telegram_send(chat_id, bot.edit_message_text, llm_response, chat_id, reply.message_id)
 
-    except (asyncio.CancelledError, RuntimeError, ValueError) as e:
-        processing_time = time.time() - start_time
-        logger.error(
-            "Error processing message from user %s after %.2fs: %s", 
+    except Exception:
+        logger.exception(
+            "Error processing message from user %s after %.2fs",
             user_id,
-            processing_time,
-            e
+            loop.time() - start_time
         )
-        await bot.reply_to(message, "Sorry, something went wrong. Please try again later.")
-    except Exception as e:
-        processing_time = time.time() - start_time
-        logger.error(
-            "Unexpected error processing message from user %s after %.2fs: %s", 
+        await telegram_send(chat_id, bot.reply_to, message, _FAIL_REPLY)
+    finally:
+        editor.cancel()
+
+def extract_stream_delta(chunk: dict) -> str:
+    """Extract the new text from a streamed completion chunk"""
+    choices = chunk.get('choices')
+    if choices:
+        delta = choices[0].get('delta') or {}
+        return delta.get('content') or choices[0].get('text') or ''
+    # Ollama-style chunks carry the text under message.content
+    return (chunk.get('message') or {}).get('content') or ''
+
+async def read_stream(response: aiohttp.ClientResponse, on_update) -> str:
+    """
+    Accumulate a streamed completion (SSE or newline-delimited JSON).
+
+    The text received so far is passed to on_update at most once every
+    STREAM_EDIT_INTERVAL seconds.
+    """
+    loop = asyncio.get_running_loop()
+    sse = response.content_type == 'text/event-stream'
+    parts = []
+    last_update = loop.time()
+    async for raw_line in response.content:
+        line = raw_line.strip()
+        if line.startswith(b"data:"):
+            line = line[5:].strip()
+        elif sse:
+            # Comments (": ping") and event/id/retry fields carry no text
+            continue
+        if not line or line == b"[DONE]":
+            continue
+
+        delta = extract_stream_delta(orjson.loads(line))
+        if not delta:
+            continue
+        parts.append(delta)
+
+        now = loop.time()
+        if now - last_update >= STREAM_EDIT_INTERVAL:
+            last_update = now
+            await on_update("".join(parts))
+    return "".join(parts)
+
+async def process_with_llm(query: str,  user_id: int = None, chat_id: int = None, on_update=None) -> str:
+    """
+    Process a query using the LLM.
+
+    When on_update is given the answer is streamed, and on_update is awaited with
+    the partial text as it grows. The complete answer is returned either way.
+    """
+    # Guarded so the preview is only built when debug logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Processing query for user %s in chat %s: %s",
             user_id,
-            processing_time,
-            e
+            chat_id,
+            preview(query, 50)
         )
-        await bot.reply_to(message, "Sorry, something went wrong. Please try again later.")
 
-async def process_with_llm(query: str,  user_id: int = None, chat_id: int = None) -> str:
-    """Process a query using the LLM"""
-    logger.debug(
-        "Processing query for user %s in chat %s: %s",
-        user_id,
-        chat_id,
-        query[:50] + ('...' if len(query) > 50 else '')
-    )
+    if CFG.exact_cache_enabled:
+        cached_response = await exact_cache_lookup(query, chat_id)
+        if cached_response is not None:
+            return cached_response
+
+    vector = None
+    if CFG.semantic_cache_enabled:
+        vector, cached_response = await semantic_cache_lookup(query, chat_id)
+        if cached_response is not None:
+            return cached_response
 
-    headers = {
-        "Authorization": f"Bearer {OPWEBUI_JWT_TOKEN}",
-        "Content-Type": "application/json"
-    }
+    body = orjson.dumps({
+        "model": CFG.opwebui_model,
+        "stream": on_update is not None,
+        "messages": [{"role": "user", "content": query}],
+        "files": _FILES
+    })
 
-    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
     try:
         logger.debug(
             "Sending request to OpenWebUI API at %s for user %s",
-            OPWEBUI_CHAT_ENDPOINT,
+            CFG.opwebui_chat_endpoint,
             user_id
         )
-        response = requests.post(
-            OPWEBUI_CHAT_ENDPOINT,
-            headers=headers,
-            json={
-                "model": OPWEBUI_MODEL,
-                "stream": False,
-                "messages": [
-                    {"role": "user", "content": query}
-                ],
-                "files": [
-                    {"type": "collection", "id": OPWEBUI_COLLECTION_ID}
-                ]
-            },
-            timeout=30
-        )
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            async with LLM_SEM:
+                async with get_session().post(
+                    CFG.opwebui_chat_endpoint,
+                    headers=_AUTH_HEADERS,
+                    timeout=LLM_STREAM_TIMEOUT if on_update else LLM_TIMEOUT,
+                    data=body
+                ) as response:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(
+                            "Received response from OpenWebUI API in %.2fs for user %s. Status code: %s",
+                            loop.time() - start_time,
+                            user_id,
+                            response.status
+                        )
 
-        api_response_time = time.time() - start_time
-        logger.debug(
-            "Received response from OpenWebUI API in %.2fs for user %s. Status code: %s",
-            api_response_time,
-            user_id,
-            response.status_code
-        )
+                    if response.status not in LLM_RETRY_STATUSES or attempt == LLM_MAX_RETRIES:
+                        response.raise_for_status()
+                        if on_update is None:
+                            response_json = orjson.loads(await response.read())
+                        else:
+                            streamed_response = await read_stream(response, on_update)
+                        break
 
-        response.raise_for_status()
-        response_json = response.json()
-        logger.debug(
-            "Response JSON structure for user %s: %s",
-            user_id,
-            list(response_json.keys()) if isinstance(response_json, dict) else 'Not a dict'
-        )
+            # Back off outside the semaphore so other chats can use the slot meanwhile
+            delay = LLM_RETRY_BACKOFF * 2 ** attempt
+            logger.warning(
+                "OpenWebUI returned %s for user %s, retrying in %.2fs (attempt %d/%d)",
+                response.status,
+                user_id,
+                delay,
+                attempt + 1,
+                LLM_MAX_RETRIES
+            )
+            await asyncio.sleep(delay)
+        if on_update is None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Response JSON structure for user %s: %s",
+                user_id,
+                list(response_json.keys()) if isinstance(response_json, dict) else 'Not a dict'
+            )
 
-    except requests.exceptions.ConnectionError:
-        api_response_time = time.time() - start_time
+    except aiohttp.ClientConnectorError:
+        api_response_time = loop.time() - start_time
         logger.error(
             "Connection error to OpenWebUI at %s for user %s after %.2fs",
-            OPWEBUI_CHAT_ENDPOINT,
+            CFG.opwebui_chat_endpoint,
             user_id,
             api_response_time
         )
         return "Error: Unable to connect to AI service. Please try again later."
-    except requests.exceptions.Timeout:
-        api_response_time = time.time() - start_time
+    except asyncio.TimeoutError:
+        api_response_time = loop.time() - start_time
         logger.error(
             "Timeout connecting to OpenWebUI for user %s after %.2fs",
             user_id,
             api_response_time
         )
         return "Error: AI service took too long to respond. Please try again later."
-    except requests.exceptions.HTTPError as e:
-        api_response_time = time.time() - start_time
-        logger.error(
-            "HTTP error from OpenWebUI for user %s after %.2fs: %s. Status code: %s",
-            user_id,
-            api_response_time,
-            e,
-            e.response.status_code
-        )
-        return f"Error: AI service returned an error ({e.response.status_code})."
-    except json.JSONDecodeError:
-        api_response_time = time.time() - start_time
+    except orjson.JSONDecodeError:
+        api_response_time = loop.time() - start_time
         logger.error(
             "Invalid JSON response from OpenWebUI for user %s after %.2fs",
             user_id,
             api_response_time
         )
         return "Error: Received invalid response from AI service."
-    except requests.exceptions.RequestException as e:
-        api_response_time = time.time() - start_time
+    except aiohttp.ClientResponseError as e:
+        api_response_time = loop.time() - start_time
         logger.error(
-            "RequestException processing query for user %s after %.2fs: %s",
+            "HTTP error from OpenWebUI for user %s after %.2fs: %s. Status code: %s",
+            user_id,
+            api_response_time,
+            e.message,
+            e.status
+        )
+        return f"Error: AI service returned an error ({e.status})."
+    except aiohttp.ClientError as e:
+        api_response_time = loop.time() - start_time
+        logger.error(
+            "ClientError processing query for user %s after %.2fs: %s",
             user_id,
             api_response_time,
             e
@@ -221,7 +784,12 @@ async def process_with_llm(query: str,  user_id: int = None, chat_id: int = None
 
     # Extract LLM response
     llm_response = ""
-    if 'choices' in response_json and len(response_json['choices']) > 0:
+    if on_update is not None:
+        if not streamed_response:
+            logger.warning("Empty streamed response from OpenWebUI for user %s", user_id)
+            return "Error: Unexpected response format from AI service."
+        llm_response = streamed_response
+    elif 'choices' in response_json and len(response_json['choices']) > 0:
         choice = response_json['choices'][0]
         if 'message' in choice and 'content' in choice['message']:
             llm_response = choice['message']['content']
@@ -234,27 +802,158 @@ async def process_with_llm(query: str,  user_id: int = None, chat_id: int = None
         )
         return "Error: Unexpected response format from AI service."
 
-    logger.debug(
-        "Extracted LLM response for user %s: %s%s",
-        user_id,
-        llm_response[:100],
-        "..." if len(llm_response) > 100 else ""
-    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Extracted LLM response for user %s: %s",
+            user_id,
+            preview(llm_response, 100)
+        )
+
+    if CFG.exact_cache_enabled and llm_response:
+        await exact_cache_store(query, llm_response, chat_id)
+    if vector is not None and llm_response:
+        await semantic_cache_store(query, llm_response, chat_id, vector)
 
     return llm_response
 
+# Telegram posts updates to this path in webhook mode, set by build_app()
+WEBHOOK_PATH = None
+
+# Keeps references to in-flight webhook dispatch tasks so they are not garbage collected
+_webhook_tasks = set()
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    """Accept an update from Telegram and dispatch it without waiting for the handlers"""
+    if CFG.webhook_secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != CFG.webhook_secret:
+        logger.warning("Rejected webhook request from %s with an invalid secret token", request.remote)
+        return web.Response(status=403)
+
+    try:
+        data = orjson.loads(await request.read())
+        # de_json raises for lists and numbers but returns None for null
+        if not isinstance(data, dict):
+            raise TypeError(f"expected a JSON object, got {type(data).__name__}")
+        update = types.Update.de_json(data)
+    # orjson.JSONDecodeError is a ValueError
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Rejected malformed webhook update: %s", e)
+        return web.Response(status=400)
+
+    # Answer Telegram right away; handle_message only queues, so ordering is kept
+    task = asyncio.create_task(bot.process_new_updates([update]))
+    _webhook_tasks.add(task)
+    task.add_done_callback(_webhook_tasks.discard)
+    return web.Response()
+
+async def run_webhook():
+    """Serve the webhook endpoint and register it with Telegram, then run until cancelled"""
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    # The path contains the bot token, so aiohttp's access log must stay off
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, CFG.webhook_host, CFG.webhook_port).start()
+        await bot.set_webhook(
+            url=CFG.webhook_url.rstrip('/') + WEBHOOK_PATH,
+            secret_token=CFG.webhook_secret
+        )
+        logger.info(
+            "Webhook server listening on %s:%s",
+            CFG.webhook_host,
+            CFG.webhook_port
+        )
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+@dataclass(frozen=True, slots=True)
+class AppContext:
+    """A configured bot and the settings it was built from"""
+    cfg: Config
+    bot: AsyncTeleBot
+
+
+def build_app(env=None) -> AppContext:
+    """
+    Configure the bot and reset the module's runtime state.
+
+    Settings are read from env when given, otherwise from config/.env and the
+    process environment. Raises ValueError when the configuration is invalid.
+    """
+    global CFG, bot, WEBHOOK_PATH, LLM_SEM, CACHE_STATS
+    global _AUTH_HEADERS, _EMBEDDING_HEADERS, _FILES, _EXACT_KEY_PREFIX
+    global CHAT_QUEUES, CHAT_WORKERS, TELEGRAM_LIMITER, CHAT_LIMITERS, _webhook_tasks
+    global _session, _redis, _semantic_index_ready
+
+    if env is None:
+        load_dotenv(root_dir / 'config' / '.env')
+    cfg = Config.from_env(env)
+
+    new_bot = AsyncTeleBot(cfg.telegram_bot_token)
+    new_bot.register_message_handler(send_welcome, commands=['help', 'start'])
+    # content_types defaults to ['text']
+    new_bot.register_message_handler(handle_message, func=lambda message: True)
+
+    CFG = cfg
+    bot = new_bot
+    WEBHOOK_PATH = f"/bot/{cfg.telegram_bot_token}"
+
+    _AUTH_HEADERS = {"Authorization": f"Bearer {cfg.opwebui_jwt_token}"}
+    _EMBEDDING_HEADERS = (
+        {"Authorization": f"Bearer {cfg.embedding_api_key}"} if cfg.embedding_api_key else None
+    )
+    _FILES = [{"type": "collection", "id": cfg.opwebui_collection_id}]
+    _EXACT_KEY_PREFIX = hashlib.sha256(f"{cfg.opwebui_model}|{cfg.opwebui_collection_id}|".encode())
+
+    # Runtime state starts empty; sessions and clients are created on first use
+    LLM_SEM = asyncio.Semaphore(cfg.llm_concurrency)
+    CHAT_QUEUES = {}
+    CHAT_WORKERS = {}
+    TELEGRAM_LIMITER = AsyncLimiter(30, 1)
+    CHAT_LIMITERS = {}
+    CACHE_STATS = Counter()
+    _webhook_tasks = set()
+    _session = None
+    _redis = None
+    _semantic_index_ready = False
+
+    return AppContext(cfg=cfg, bot=new_bot)
+
+
 async def main():
     """
     Main entry point for the application.
     """
     logger.info("Starting Telebot-OpenWebUI")
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=CFG.http_workers)
+    )
     try:
-        await bot.polling()
+        if CFG.webhook_url:
+            await run_webhook()
+        else:
+            # A webhook left over from webhook mode would make getUpdates fail
+            await bot.delete_webhook()
+            await bot.polling()
     except Exception as e:
-        logger.error("Bot polling failed with error: %s", e)
+        logger.error("Bot failed with error: %s", e)
         raise
+    finally:
+        await close_session()
+        await close_redis()
+        # Polling closes telebot's own session when it stops, webhook mode does not
+        if session_manager.session is not None:
+            await bot.close_session()
 
 if __name__ == "__main__":
+    setup_logging()
+    try:
+        build_app()
+    except ValueError as e:
+        logger.error("%s", e)
+        exit(1)
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -15,9 +15,13 @@ def run_tests():
             "pytest>=7.0",
             "pytest-asyncio>=0.21.0",
             "pytest-mock>=3.11.1",
-            "requests-mock>=1.11.0",
             "python-dotenv",
-            "pytelegrambotapi"
+            "pytelegrambotapi",
+            "aiohttp",
+            "aiolimiter",
+            "orjson",
+            "redis",
+            "ujson"
         ], check=True)
         
         # Run tests using the virtual environment's Python
@@ -0,0 +1,56 @@
+"""Shared fixtures for the test suite."""
+
+import sys
+import os
+
+# Add the project root to the path so we can import main.py
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import dataclasses
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
+
+
+@pytest.fixture
+def env():
+    """Environment variables the app is built from."""
+    return {
+        'TELEGRAM_BOT_TOKEN': '123456789:ABCdefGHIjklMNOpqrSTUvwxYZ',
+        'OPWEBUI_CHAT_ENDPOINT': 'http://test.example.com/api/chat',
+        'OPWEBUI_JWT_TOKEN': 'test_token',
+        'OPWEBUI_MODEL': 'test_model',
+        'OPWEBUI_COLLECTION_ID': 'test_collection',
+        'WELCOME_MESSAGE': 'Welcome!',
+    }
+
+
+@pytest.fixture
+def app(env):
+    """Build the app with fresh runtime state for each test."""
+    return main.build_app(env=env)
+
+
+@pytest.fixture
+def mock_openwebui(monkeypatch):
+    """Serve canned responses from a local OpenWebUI stand-in and point main at it."""
+    @asynccontextmanager
+    async def serve(response):
+        async def chat(request):
+            return response
+
+        app = web.Application()
+        app.router.add_post('/api/chat', chat)
+        async with TestServer(app) as server:
+            endpoint = str(server.make_url('/api/chat'))
+            monkeypatch.setattr(main, 'CFG', dataclasses.replace(main.CFG, opwebui_chat_endpoint=endpoint))
+            try:
+                yield server
+            finally:
+                await main.close_session()
+
+    return serve
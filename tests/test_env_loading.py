@@ -1,61 +1,61 @@
 """Tests for environment variable loading and validation."""
 
-import os
-import sys
-from unittest.mock import patch
 import pytest
 
-# Add the project root to the path so we can import main.py
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import main
 
 
-def test_env_variables_present():
+def test_env_variables_present(app):
     """Test that environment variables are loaded correctly."""
-    # Mock environment variables with valid Telegram token format
-    with patch.dict(os.environ, {
-        'TELEGRAM_BOT_TOKEN': '123456789:ABCdefGHIjklMNOpqrSTUvwxYZ',
+    assert app.cfg is main.CFG
+    assert app.bot is main.bot
+
+    # Check that variables are loaded correctly
+    assert main.CFG.telegram_bot_token == '123456789:ABCdefGHIjklMNOpqrSTUvwxYZ'
+    assert main.CFG.opwebui_chat_endpoint == 'http://test.example.com/api/chat'
+    assert main.CFG.opwebui_jwt_token == 'test_token'
+    assert main.CFG.opwebui_model == 'test_model'
+    assert main.CFG.welcome_message == 'Welcome!'
+    assert main.WEBHOOK_PATH == '/bot/123456789:ABCdefGHIjklMNOpqrSTUvwxYZ'
+
+
+def test_missing_env_variables():
+    """Test that missing environment variables are detected."""
+    with pytest.raises(ValueError, match="Missing required environment variables"):
+        main.build_app(env={})
+
+
+def test_config_from_env():
+    """Test that optional settings are parsed with their types and defaults."""
+    config = main.Config.from_env({
+        'TELEGRAM_BOT_TOKEN': 'token',
         'OPWEBUI_CHAT_ENDPOINT': 'http://test.example.com',
         'OPWEBUI_JWT_TOKEN': 'test_jwt',
         'OPWEBUI_MODEL': 'test_model',
         'WELCOME_MESSAGE': 'Welcome!',
-    }):
-        # Remove main from sys.modules if it exists to force re-import
-        for module_name in list(sys.modules.keys()):
-            if module_name.startswith('main'):
-                del sys.modules[module_name]
-        
-        import main
-        
-        # Check that variables are loaded correctly
-        assert main.TELEGRAM_BOT_TOKEN == '123456789:ABCdefGHIjklMNOpqrSTUvwxYZ'
-        assert main.OPWEBUI_CHAT_ENDPOINT == 'http://test.example.com'
-        assert main.OPWEBUI_JWT_TOKEN == 'test_jwt'
-        assert main.OPWEBUI_MODEL == 'test_model'
-        assert main.WELCOME_MESSAGE == 'Welcome!'
+        'REDIS_URL': 'redis://localhost:6379/0',
+        'MAX_QUERY_CHARS': '500',
+    })
 
+    assert config.max_query_chars == 500
+    assert config.llm_concurrency == 8
+    assert config.opwebui_collection_id is None
+    assert config.exact_cache_enabled
+    assert not config.semantic_cache_enabled
 
-def test_missing_env_variables():
-    """Test that missing environment variables are detected."""
-    # Store original environment
-    original_environ = dict(os.environ)
-    
-    try:
-        # Clear all environment variables
-        os.environ.clear()
-        
-        # Remove main from sys.modules if it exists to force re-import
-        for module_name in list(sys.modules.keys()):
-            if module_name.startswith('main'):
-                del sys.modules[module_name]
-        
-        # Mock the load_dotenv function to prevent loading from file
-        with patch('dotenv.load_dotenv'):
-            # This should raise SystemExit when main is imported
-            with pytest.raises(SystemExit):
-                import main
-                # Force evaluation
-                print(main)
-    finally:
-        # Restore original environment
-        os.environ.clear()
-        os.environ.update(original_environ)
\ No newline at end of file
+    with pytest.raises(ValueError, match="Invalid CACHE_TTL: 'abc'"):
+        main.Config.from_env({
+            'TELEGRAM_BOT_TOKEN': 'token',
+            'OPWEBUI_CHAT_ENDPOINT': 'http://test.example.com',
+            'OPWEBUI_JWT_TOKEN': 'test_jwt',
+            'OPWEBUI_MODEL': 'test_model',
+            'WELCOME_MESSAGE': 'Welcome!',
+            'CACHE_TTL': 'abc',
+        })
+
+    with pytest.raises(ValueError, match="OPWEBUI_MODEL, WELCOME_MESSAGE"):
+        main.Config.from_env({
+            'TELEGRAM_BOT_TOKEN': 'token',
+            'OPWEBUI_CHAT_ENDPOINT': 'http://test.example.com',
+            'OPWEBUI_JWT_TOKEN': 'test_jwt',
+        })
@@ -1,15 +1,15 @@
 """Tests for LLM processing functions."""
 
-import sys
-import os
-from unittest.mock import patch, Mock
-
-# Add the project root to the path so we can import main.py
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import logging
+import dataclasses
+from unittest.mock import patch, AsyncMock, call
 
 import pytest
-import requests
-import requests_mock
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
 
 
 @pytest.fixture
@@ -38,152 +38,139 @@ def mock_response_data_with_text():
     }
 
 
-@pytest.fixture
-def mock_env_vars():
-    """Mock environment variables needed for the LLM processing."""
-    return patch.dict(os.environ, {
-        'TELEGRAM_BOT_TOKEN': '123456789:ABCdefGHIjklMNOpqrSTUvwxYZ',
-        'OPWEBUI_CHAT_ENDPOINT': 'http://test.example.com/api/chat',
-        'OPWEBUI_JWT_TOKEN': 'test_token',
-        'OPWEBUI_MODEL': 'test_model',
-        'OPWEBUI_COLLECTION_ID': 'test_collection',
-        'WELCOME_MESSAGE': 'Welcome!',
-    })
-
-
 @pytest.mark.asyncio
-async def test_process_with_llm_success(mock_response_data, mock_env_vars):
+async def test_process_with_llm_success(mock_response_data, app, mock_openwebui):
     """Test successful LLM processing."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-
-        with requests_mock.Mocker() as m:
-            m.post(
-                'http://test.example.com/api/chat',
-                json=mock_response_data,
-                status_code=200
-            )
-            
-            result = await main.process_with_llm("Test query", 12345, 67890)
-            assert result == "This is a test response from the AI."
+    async with mock_openwebui(web.json_response(mock_response_data)):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+        assert result == "This is a test response from the AI."
 
 
 @pytest.mark.asyncio
-async def test_process_with_llm_success_text_field(mock_response_data_with_text, mock_env_vars):
+async def test_process_with_llm_success_text_field(mock_response_data_with_text, app, mock_openwebui):
     """Test successful LLM processing with text field."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-
-        with requests_mock.Mocker() as m:
-            m.post(
-                'http://test.example.com/api/chat',
-                json=mock_response_data_with_text,
-                status_code=200
-            )
-            
-            result = await main.process_with_llm("Test query", 12345, 67890)
-            assert result == "This is a test response with text field."
+    async with mock_openwebui(web.json_response(mock_response_data_with_text)):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+        assert result == "This is a test response with text field."
 
 
 @pytest.mark.asyncio
-async def test_process_with_llm_http_error(mock_env_vars):
+async def test_process_with_llm_http_error(app, mock_openwebui):
     """Test LLM processing with HTTP error."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-
-        with requests_mock.Mocker() as m:
-            m.post(
-                'http://test.example.com/api/chat',
-                status_code=500,
-                text='Internal Server Error'
-            )
-            
-            result = await main.process_with_llm("Test query", 12345, 67890)
-            assert result == "Error: AI service returned an error (500)."
+    async with mock_openwebui(web.Response(status=500, text='Internal Server Error')):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+        assert result == "Error: AI service returned an error (500)."
 
 
 @pytest.mark.asyncio
-async def test_process_with_llm_timeout(mock_env_vars):
+async def test_process_with_llm_timeout(app):
     """Test LLM processing with timeout."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-
-        with requests_mock.Mocker() as m:
-            m.post(
-                'http://test.example.com/api/chat',
-                exc=requests.exceptions.Timeout
-            )
-            
-            result = await main.process_with_llm("Test query", 12345, 67890)
-            assert result == "Error: AI service took too long to respond. Please try again later."
+    with patch.object(main.aiohttp.ClientSession, 'post', side_effect=asyncio.TimeoutError):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+        assert result == "Error: AI service took too long to respond. Please try again later."
+    await main.close_session()
 
 
 @pytest.mark.asyncio
-async def test_process_with_llm_connection_error(mock_env_vars):
+async def test_process_with_llm_connection_error(app, monkeypatch):
     """Test LLM processing with connection error."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-
-        with requests_mock.Mocker() as m:
-            m.post(
-                'http://test.example.com/api/chat',
-                exc=requests.exceptions.ConnectionError
-            )
-            
-            result = await main.process_with_llm("Test query", 12345, 67890)
-            assert result == "Error: Unable to connect to AI service. Please try again later."
+    # Nothing listens on port 1, so the connection is refused
+    monkeypatch.setattr(main, 'CFG', dataclasses.replace(main.CFG, opwebui_chat_endpoint='http://127.0.0.1:1/api/chat'))
+    try:
+        result = await main.process_with_llm("Test query", 12345, 67890)
+        assert result == "Error: Unable to connect to AI service. Please try again later."
+    finally:
+        await main.close_session()
 
 
 @pytest.mark.asyncio
-async def test_process_with_llm_invalid_json(mock_env_vars):
+async def test_process_with_llm_invalid_json(app, mock_openwebui):
     """Test LLM processing with invalid JSON response."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-
-        with requests_mock.Mocker() as m:
-            m.post(
-                'http://test.example.com/api/chat',
-                text='Invalid JSON response',
-                status_code=200
-            )
-            
-            result = await main.process_with_llm("Test query", 12345, 67890)
-            assert result == "Error: Received invalid response from AI service."
+    async with mock_openwebui(web.Response(text='Invalid JSON response')):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+        assert result == "Error: Received invalid response from AI service."
 
 
 @pytest.mark.asyncio
-async def test_process_with_llm_unexpected_format(mock_env_vars):
+async def test_process_with_llm_unexpected_format(app, mock_openwebui):
     """Test LLM processing with unexpected response format."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-
-        with requests_mock.Mocker() as m:
-            m.post(
-                'http://test.example.com/api/chat',
-                json={"unexpected": "format"},
-                status_code=200
-            )
-            
+    async with mock_openwebui(web.json_response({"unexpected": "format"})):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+        assert result == "Error: Unexpected response format from AI service."
+
+@pytest.mark.asyncio
+async def test_process_with_llm_retries_gateway_errors(mock_response_data, app, monkeypatch):
+    """Test that gateway errors are retried and the request carries auth and a JSON body."""
+    monkeypatch.setattr(main, 'LLM_RETRY_BACKOFF', 0)
+    statuses = [503, 200]
+    auth_headers = []
+
+    async def chat(request):
+        auth_headers.append(request.headers.get('Authorization'))
+        assert request.headers.get('Content-Type') == 'application/json'
+        assert (await request.json())['messages'] == [{"role": "user", "content": "Test query"}]
+        if statuses.pop(0) == 503:
+            return web.Response(status=503, text='Service Unavailable')
+        return web.json_response(mock_response_data)
+
+    app = web.Application()
+    app.router.add_post('/api/chat', chat)
+    async with TestServer(app) as server:
+        monkeypatch.setattr(main, 'CFG', dataclasses.replace(main.CFG, opwebui_chat_endpoint=str(server.make_url('/api/chat'))))
+        result = await main.process_with_llm("Test query", 12345, 67890)
+        await main.close_session()
+
+    assert result == "This is a test response from the AI."
+    assert auth_headers == ["Bearer test_token", "Bearer test_token"]
+
+
+@pytest.mark.asyncio
+async def test_process_with_llm_streaming(app, monkeypatch, mock_openwebui):
+    """Test that a streamed response is accumulated and reported as it grows."""
+    monkeypatch.setattr(main, 'STREAM_EDIT_INTERVAL', 0)
+    body = (
+        'data: {"choices": [{"delta": {"role": "assistant"}}]}\n\n'
+        'data: {"choices": [{"delta": {"content": "This is "}}]}\n\n'
+        'data: {"choices": [{"delta": {"content": "streamed."}}]}\n\n'
+        'data: [DONE]\n\n'
+    )
+    on_update = AsyncMock()
+
+    async with mock_openwebui(web.Response(text=body, content_type='text/event-stream')):
+        result = await main.process_with_llm("Test query", 12345, 67890, on_update=on_update)
+
+    assert result == "This is streamed."
+    assert on_update.await_args_list == [call("This is "), call("This is streamed.")]
+
+
+@pytest.mark.asyncio
+async def test_process_with_llm_skips_debug_previews(mock_response_data, app, caplog, mock_openwebui):
+    """Test that log previews are not built when debug logging is disabled."""
+    caplog.set_level(logging.INFO, logger="telebot-opwebui")
+    with patch.object(main, 'preview', wraps=main.preview) as preview:
+        async with mock_openwebui(web.json_response(mock_response_data)):
             result = await main.process_with_llm("Test query", 12345, 67890)
-            assert result == "Error: Unexpected response format from AI service."
\ No newline at end of file
+
+    assert result == "This is a test response from the AI."
+    preview.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_process_with_llm_streaming_ignores_sse_fields(app, monkeypatch, mock_openwebui):
+    """Test that SSE comments and non-data fields in a stream are skipped."""
+    monkeypatch.setattr(main, 'STREAM_EDIT_INTERVAL', 0)
+    body = (
+        ': keep-alive\n\n'
+        'retry: 1000\n\n'
+        'event: message\n'
+        'id: 1\n'
+        'data: {"choices": [{"delta": {"content": "This is "}}]}\n\n'
+        ': ping\n\n'
+        'data:{"choices": [{"delta": {"content": "streamed."}}]}\n\n'
+        'data: [DONE]\n\n'
+    )
+
+    async with mock_openwebui(web.Response(text=body, content_type='text/event-stream')):
+        result = await main.process_with_llm("Test query", 12345, 67890, on_update=AsyncMock())
+
+    assert result == "This is streamed."
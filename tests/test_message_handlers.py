@@ -1,14 +1,18 @@
 """Tests for message handlers."""
 
-import sys
-import os
-from unittest.mock import patch, Mock, AsyncMock
-
-# Add the project root to the path so we can import main.py
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import socket
+import asyncio
+import logging
+from unittest.mock import patch, Mock, AsyncMock, ANY, call
 
+import aiohttp
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
 from telebot import types
+from telebot.asyncio_helper import ApiTelegramException
+
+import main
 
 @pytest.fixture
 def mock_message():
@@ -22,67 +26,404 @@ def mock_message():
     message.message_id = 111
     return message
 
+@pytest.mark.asyncio
+async def test_send_welcome(mock_message, app):
+    """Test the welcome message handler."""
+    # Mock the bot.reply_to method
+    app.bot.reply_to = AsyncMock()
+    
+    await main.send_welcome(mock_message)
+    app.bot.reply_to.assert_called_once_with(mock_message, "Welcome!")
+    assert 67890 not in main.CHAT_LIMITERS
+
+@pytest.mark.asyncio
+async def test_handle_message(mock_message, app, monkeypatch):
+    """Test the message handler."""
+    # Mock the process_with_llm function, bot.reply_to method, and bot.send_chat_action
+    monkeypatch.setattr(main, 'process_with_llm', AsyncMock(return_value="Test response"))
+    app.bot.reply_to = AsyncMock()
+    app.bot.send_chat_action = AsyncMock()
+
+    await main.handle_message(mock_message)
+    await main.CHAT_QUEUES[67890].join()
+    main.process_with_llm.assert_called_once_with("Test message", 12345, 67890, on_update=ANY)
+    app.bot.reply_to.assert_called_once_with(mock_message, "Test response")
+    app.bot.send_chat_action.assert_called_once_with(67890, "typing")
+
+@pytest.mark.asyncio
+async def test_handle_message_with_error(mock_message, app, monkeypatch):
+    """Test the message handler with error."""
+    # Mock the process_with_llm function to raise an exception
+    monkeypatch.setattr(main, 'process_with_llm', AsyncMock(side_effect=Exception("Test error")))
+    app.bot.reply_to = AsyncMock()
+    app.bot.send_chat_action = AsyncMock()
+
+    await main.handle_message(mock_message)
+    await main.CHAT_QUEUES[67890].join()
+    main.process_with_llm.assert_called_once_with("Test message", 12345, 67890, on_update=ANY)
+    app.bot.reply_to.assert_called_once_with(mock_message, main._FAIL_REPLY)
+    app.bot.send_chat_action.assert_called_once_with(67890, "typing")
+
+@pytest.mark.asyncio
+async def test_handle_message_rejects_empty_query(mock_message, app, monkeypatch):
+    """Test that blank messages are answered without queueing an LLM call."""
+    mock_message.text = "   "
+    monkeypatch.setattr(main, 'process_with_llm', AsyncMock())
+    app.bot.reply_to = AsyncMock()
+
+    await main.handle_message(mock_message)
+    app.bot.reply_to.assert_called_once_with(mock_message, "Please send a question.")
+    main.process_with_llm.assert_not_called()
+    assert 67890 not in main.CHAT_QUEUES
+    assert 67890 not in main.CHAT_LIMITERS
+
+@pytest.mark.asyncio
+async def test_handle_message_rejects_long_query(mock_message, app, monkeypatch):
+    """Test that queries over MAX_QUERY_CHARS are refused without queueing an LLM call."""
+    mock_message.text = "x" * (main.CFG.max_query_chars + 1)
+    monkeypatch.setattr(main, 'process_with_llm', AsyncMock())
+    app.bot.reply_to = AsyncMock()
+
+    await main.handle_message(mock_message)
+    app.bot.reply_to.assert_called_once_with(
+        mock_message, "Query too long. Please keep it under 2000 characters."
+    )
+    main.process_with_llm.assert_not_called()
+    assert 67890 not in main.CHAT_QUEUES
+    assert 67890 not in main.CHAT_LIMITERS
+
+@pytest.mark.asyncio
+async def test_handle_message_streams_response(mock_message, app, monkeypatch):
+    """Test that streamed partial answers are sent once and then edited in place."""
+    async def process_with_llm(query, user_id, chat_id, on_update=None):
+        await on_update("Test")
+        await asyncio.sleep(0.05)
+        await on_update("Test response")
+        await asyncio.sleep(0.05)
+        return "Test response, complete"
+
+    monkeypatch.setattr(main, 'process_with_llm', process_with_llm)
+    app.bot.reply_to = AsyncMock(return_value=Mock(message_id=222))
+    app.bot.edit_message_text = AsyncMock()
+    app.bot.send_chat_action = AsyncMock()
+    main.CHAT_LIMITERS[67890] = main.AsyncLimiter(100, 1)
+
+    await main.handle_message(mock_message)
+    await main.CHAT_QUEUES[67890].join()
+
+    app.bot.reply_to.assert_called_once_with(mock_message, "Test")
+    assert app.bot.edit_message_text.await_args_list == [
+        call("Test response", 67890, 222),
+        call("Test response, complete", 67890, 222),
+    ]
+
+@pytest.mark.asyncio
+async def test_stream_updates_do_not_wait_for_telegram(mock_message, app, monkeypatch):
+    """Test that a slow Telegram send does not hold up reading the streamed answer."""
+    release_reply = asyncio.Event()
+
+    async def reply_to(message, text):
+        await release_reply.wait()
+        return Mock(message_id=222)
+
+    async def process_with_llm(query, user_id, chat_id, on_update=None):
+        await on_update("Test")
+        await asyncio.sleep(0.01)
+        # The reply is still blocked in Telegram, yet the next update returns at once
+        await asyncio.wait_for(on_update("Test response"), timeout=0.1)
+        release_reply.set()
+        return "Test response, complete"
+
+    monkeypatch.setattr(main, 'process_with_llm', process_with_llm)
+    app.bot.reply_to = AsyncMock(side_effect=reply_to)
+    app.bot.edit_message_text = AsyncMock()
+    app.bot.send_chat_action = AsyncMock()
+    main.CHAT_LIMITERS[67890] = main.AsyncLimiter(100, 1)
+
+    await main.handle_message(mock_message)
+    await main.CHAT_QUEUES[67890].join()
+
+    app.bot.reply_to.assert_called_once_with(mock_message, "Test")
+    assert app.bot.edit_message_text.await_args_list[-1] == call("Test response, complete", 67890, 222)
+
+@pytest.mark.asyncio
+async def test_handle_message_preserves_chat_order(app, monkeypatch):
+    """Test that messages in one chat are answered in order while other chats proceed."""
+    finished = []
+
+    async def process_with_llm(query, user_id, chat_id, on_update=None):
+        # The first message is the slowest, so it would finish last if run concurrently
+        await asyncio.sleep({"first": 0.05, "second": 0.01, "other": 0}[query])
+        finished.append(query)
+        return query
+
+    def make_message(chat_id, text, message_id):
+        message = Mock(spec=types.Message)
+        message.from_user = Mock()
+        message.from_user.id = 12345
+        message.chat = Mock()
+        message.chat.id = chat_id
+        message.text = text
+        message.message_id = message_id
+        return message
+
+    monkeypatch.setattr(main, 'process_with_llm', process_with_llm)
+    app.bot.reply_to = AsyncMock()
+    app.bot.send_chat_action = AsyncMock()
+
+    await main.handle_message(make_message(1, "first", 1))
+    await main.handle_message(make_message(1, "second", 2))
+    await main.handle_message(make_message(2, "other", 3))
+    await main.CHAT_QUEUES[1].join()
+    await main.CHAT_QUEUES[2].join()
+
+    assert finished == ["other", "first", "second"]
+
+
+@pytest.mark.asyncio
+async def test_handle_message_refuses_when_backlog_full(app, monkeypatch):
+    """Test that a full chat queue refuses new messages instead of letting them overtake."""
+    release = asyncio.Event()
+    processed = []
+
+    async def process_with_llm(query, user_id, chat_id, on_update=None):
+        await release.wait()
+        processed.append(query)
+        return query
+
+    def make_message(text, message_id):
+        message = Mock(spec=types.Message)
+        message.from_user = Mock()
+        message.from_user.id = 12345
+        message.chat = Mock()
+        message.chat.id = 67890
+        message.text = text
+        message.message_id = message_id
+        return message
+
+    monkeypatch.setattr(main, 'CHAT_QUEUE_SIZE', 2)
+    monkeypatch.setattr(main, 'process_with_llm', process_with_llm)
+    app.bot.reply_to = AsyncMock()
+    app.bot.send_chat_action = AsyncMock()
+    main.CHAT_LIMITERS[67890] = main.AsyncLimiter(100, 1)
+
+    # q0 is taken by the worker, q1 and q2 fill the queue
+    for i in range(3):
+        await main.handle_message(make_message(f"q{i}", i))
+        await asyncio.sleep(0.01)
+    refused = make_message("q3", 3)
+    await asyncio.wait_for(main.handle_message(refused), timeout=0.5)
+    app.bot.reply_to.assert_called_once_with(
+        refused, "Too many pending messages. Please wait for the answers before asking more."
+    )
+
+    # A slot frees up and a newer message takes it, behind the older ones
+    release.set()
+    while main.CHAT_QUEUES[67890].full():
+        await asyncio.sleep(0)
+    await main.handle_message(make_message("q4", 4))
+    await main.CHAT_QUEUES[67890].join()
+
+    assert processed == ["q0", "q1", "q2", "q4"]
+
+
+@pytest.mark.asyncio
+async def test_chat_worker_exits_when_idle(mock_message, app, monkeypatch):
+    """Test that an idle chat worker stops and releases its queue."""
+    monkeypatch.setattr(main, 'CHAT_IDLE_TIMEOUT', 0.01)
+    monkeypatch.setattr(main, 'process_with_llm', AsyncMock(return_value="Test response"))
+    app.bot.reply_to = AsyncMock()
+    app.bot.send_chat_action = AsyncMock()
+
+    await main.handle_message(mock_message)
+    worker = main.CHAT_WORKERS[67890]
+    await worker
+
+    assert 67890 not in main.CHAT_QUEUES
+    assert 67890 not in main.CHAT_WORKERS
+    app.bot.reply_to.assert_called_once_with(mock_message, "Test response")
+
+
+@pytest.mark.asyncio
+async def test_telegram_send_retries_after_rate_limit(app):
+    """Test that a 429 from Telegram is retried after retry_after."""
+    rate_limited = ApiTelegramException('sendMessage', Mock(), {
+        'error_code': 429,
+        'description': 'Too Many Requests: retry after 0',
+        'parameters': {'retry_after': 0}
+    })
+    send = AsyncMock(side_effect=[rate_limited, "sent"])
+
+    with patch.object(main.random, 'uniform', return_value=0):
+        result = await main.telegram_send(None, send, 67890, "Test response")
+
+    assert result == "sent"
+    assert send.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_telegram_send_busy_chat_keeps_global_capacity(app, monkeypatch):
+    """Test that sends waiting on a busy chat do not use up the global rate limit."""
+    monkeypatch.setattr(main, 'TELEGRAM_LIMITER', main.AsyncLimiter(2, 60))
+    send = AsyncMock(return_value="sent")
+
+    # The second send to chat 1 waits about a second for the chat's limit
+    busy_chat = asyncio.gather(
+        main.telegram_send(1, send, 1, "first"),
+        main.telegram_send(1, send, 1, "second")
+    )
+    await asyncio.sleep(0.05)
+
+    # Chat 2 still gets the remaining global slot right away
+    assert await asyncio.wait_for(main.telegram_send(2, send, 2, "other"), timeout=0.5) == "sent"
+    busy_chat.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await busy_chat
+
+
+@pytest.mark.asyncio
+async def test_telegram_send_raises_other_errors(app):
+    """Test that non rate-limit Telegram errors are not retried."""
+    forbidden = ApiTelegramException('sendMessage', Mock(), {
+        'error_code': 403,
+        'description': 'Forbidden: bot was blocked by the user'
+    })
+    send = AsyncMock(side_effect=forbidden)
+
+    with pytest.raises(ApiTelegramException):
+        await main.telegram_send(67890, send, 67890, "Test response")
+    send.assert_awaited_once()
+
+
+@pytest.fixture
+def update_data():
+    """Sample Telegram update as posted to the webhook."""
+    return {
+        "update_id": 1,
+        "message": {
+            "message_id": 111,
+            "date": 1700000000,
+            "chat": {"id": 67890, "type": "private"},
+            "from": {"id": 12345, "is_bot": False, "first_name": "Test"},
+            "text": "Test message"
+        }
+    }
+
+
 @pytest.fixture
-def mock_env_vars():
-    """Mock environment variables needed for the message handlers."""
-    return patch.dict(os.environ, {
-        'TELEGRAM_BOT_TOKEN': '123456789:ABCdefGHIjklMNOpqrSTUvwxYZ',
-        'OPWEBUI_CHAT_ENDPOINT': 'http://test.example.com/api/chat',
-        'OPWEBUI_JWT_TOKEN': 'test_token',
-        'OPWEBUI_MODEL': 'test_model',
-        'OPWEBUI_COLLECTION_ID': 'test_collection',
-        'WELCOME_MESSAGE': 'Welcome!',
+def webhook_app(env):
+    """Build the app with a webhook secret token configured."""
+    return main.build_app(env={**env, 'WEBHOOK_SECRET': 'secret'})
+
+
+@pytest.mark.asyncio
+async def test_webhook_dispatches_update(update_data, webhook_app):
+    """Test that the webhook acknowledges an update and dispatches it to the bot."""
+    webhook_app.bot.process_new_updates = AsyncMock()
+    server = web.Application()
+    server.router.add_post(main.WEBHOOK_PATH, main.handle_webhook)
+
+    async with TestClient(TestServer(server)) as client:
+        response = await client.post(
+            main.WEBHOOK_PATH,
+            json=update_data,
+            headers={"X-Telegram-Bot-Api-Secret-Token": "secret"}
+        )
+        assert response.status == 200
+        await asyncio.gather(*main._webhook_tasks)
+
+    update = webhook_app.bot.process_new_updates.await_args.args[0][0]
+    assert update.update_id == 1
+    assert update.message.text == "Test message"
+
+
+@pytest.mark.asyncio
+async def test_webhook_rejects_invalid_secret(update_data, webhook_app):
+    """Test that webhook requests without the configured secret token are refused."""
+    webhook_app.bot.process_new_updates = AsyncMock()
+    server = web.Application()
+    server.router.add_post(main.WEBHOOK_PATH, main.handle_webhook)
+
+    async with TestClient(TestServer(server)) as client:
+        response = await client.post(
+            main.WEBHOOK_PATH,
+            json=update_data,
+            headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+        )
+        assert response.status == 403
+
+    webhook_app.bot.process_new_updates.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_run_webhook_keeps_token_out_of_logs(update_data, env, caplog):
+    """Test that requests to the webhook path, which contains the bot token, are not logged."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    app = main.build_app(env={
+        **env,
+        'WEBHOOK_URL': 'https://bot.example.com',
+        'WEBHOOK_HOST': '127.0.0.1',
+        'WEBHOOK_PORT': str(port)
     })
+    app.bot.set_webhook = AsyncMock()
+    app.bot.process_new_updates = AsyncMock()
+    caplog.set_level(logging.DEBUG)
+
+    server = asyncio.create_task(main.run_webhook())
+    try:
+        while not app.bot.set_webhook.called:
+            await asyncio.sleep(0.01)
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"http://127.0.0.1:{port}{main.WEBHOOK_PATH}", json=update_data) as response:
+                assert response.status == 200
+        await asyncio.gather(*main._webhook_tasks)
+    finally:
+        server.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await server
+
+    app.bot.process_new_updates.assert_awaited_once()
+    assert app.cfg.telegram_bot_token not in caplog.text
+
 
 @pytest.mark.asyncio
-async def test_send_welcome(mock_message, mock_env_vars):
-    """Test the welcome message handler."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-        
-        # Mock the bot.reply_to method
-        main.bot.reply_to = AsyncMock()
-        
-        await main.send_welcome(mock_message)
-        main.bot.reply_to.assert_called_once()
-
-@pytest.mark.asyncio
-async def test_handle_message(mock_message, mock_env_vars):
-    """Test the message handler."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
+@pytest.mark.parametrize("body", [b"[1, 2]", b"5", b"null", b"not json"])
+async def test_webhook_rejects_malformed_update(body, webhook_app):
+    """Test that webhook bodies which are not a JSON object are refused with 400."""
+    webhook_app.bot.process_new_updates = AsyncMock()
+    server = web.Application()
+    server.router.add_post(main.WEBHOOK_PATH, main.handle_webhook)
 
-        # Mock the process_with_llm function, bot.reply_to method, and bot.send_chat_action
-        main.process_with_llm = AsyncMock(return_value="Test response")
-        main.bot.reply_to = AsyncMock()
-        main.bot.send_chat_action = AsyncMock()
+    async with TestClient(TestServer(server)) as client:
+        response = await client.post(
+            main.WEBHOOK_PATH,
+            data=body,
+            headers={"X-Telegram-Bot-Api-Secret-Token": "secret"}
+        )
+        assert response.status == 400
+
+    webhook_app.bot.process_new_updates.assert_not_called()
 
-        await main.handle_message(mock_message)
-        main.process_with_llm.assert_called_once_with("Test message", 12345, 67890)
-        main.bot.reply_to.assert_called_once_with(mock_message, "Test response")
-        main.bot.send_chat_action.assert_called_once_with(67890, "typing")
 
 @pytest.mark.asyncio
-async def test_handle_message_with_error(mock_message, mock_env_vars):
-    """Test the message handler with error."""
-    with mock_env_vars:
-        # Re-import main to pick up the mocked environment
-        if 'main' in sys.modules:
-            del sys.modules['main']
-        import main
-
-        # Mock the process_with_llm function to raise an exception
-        main.process_with_llm = AsyncMock(side_effect=Exception("Test error"))
-        main.bot.reply_to = AsyncMock()
-        main.bot.send_chat_action = AsyncMock()
-
-        await main.handle_message(mock_message)
-        main.process_with_llm.assert_called_once_with("Test message", 12345, 67890)
-        main.bot.reply_to.assert_called_once()
-        main.bot.send_chat_action.assert_called_once_with(67890, "typing")
\ No newline at end of file
+async def test_main_closes_telebot_session_in_webhook_mode(env):
+    """Test that shutting down in webhook mode closes telebot's HTTP session."""
+    app = main.build_app(env={
+        **env,
+        'WEBHOOK_URL': 'https://bot.example.com',
+        'WEBHOOK_HOST': '127.0.0.1',
+        'WEBHOOK_PORT': '0'
+    })
+    app.bot.set_webhook = AsyncMock()
+    session = await main.session_manager.get_session()
+
+    bot_task = asyncio.create_task(main.main())
+    while not app.bot.set_webhook.called:
+        await asyncio.sleep(0.01)
+    bot_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await bot_task
+
+    assert session.closed
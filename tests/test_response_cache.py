@@ -0,0 +1,158 @@
+"""Tests for the LLM response cache."""
+
+import hashlib
+import dataclasses
+from array import array
+from unittest.mock import patch, AsyncMock
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
+
+
+def mock_redis(search_result=None, exact_result=None):
+    """Create a fake Redis client returning the given GET value and raw FT.SEARCH reply."""
+    async def execute_command(command, *args):
+        if command == "FT.SEARCH":
+            return search_result
+        return b"OK"
+
+    client = AsyncMock()
+    client.get = AsyncMock(return_value=exact_result)
+    client.execute_command = AsyncMock(side_effect=execute_command)
+    return client
+
+
+@pytest.fixture
+def exact_env(env):
+    """Environment variables with only the exact-match cache enabled."""
+    return {**env, 'REDIS_URL': 'redis://localhost:6379/0'}
+
+
+@pytest.fixture
+def exact_app(exact_env):
+    """Build the app with only the exact-match cache enabled."""
+    return main.build_app(env=exact_env)
+
+
+@pytest.fixture
+def semantic_app(exact_env):
+    """Build the app with the semantic cache enabled."""
+    return main.build_app(env={**exact_env, 'EMBEDDING_ENDPOINT': 'http://test.example.com/api/embeddings'})
+
+
+@pytest.fixture
+def vector():
+    """Sample FLOAT32 query embedding."""
+    return array('f', [0.6, 0.8]).tobytes()
+
+
+def test_exact_cache_key(exact_app):
+    """Test that the exact-match key hashes the model, collection and normalized query."""
+    expected = hashlib.sha256(b"test_model|test_collection|test query").hexdigest()
+    assert main.exact_cache_key(" Test  Query") == f"llm:{expected}"
+    assert main.exact_cache_key("test query") == f"llm:{expected}"
+
+
+@pytest.mark.asyncio
+async def test_exact_cache_hit(exact_app, monkeypatch):
+    """Test that an identical cached query is answered without calling the LLM."""
+    monkeypatch.setattr(main, '_redis', mock_redis(exact_result=b'Cached answer'))
+
+    with patch.object(main.aiohttp.ClientSession, 'post') as post:
+        result = await main.process_with_llm("  Test   QUERY ", 12345, 67890)
+    assert result == "Cached answer"
+    post.assert_not_called()
+
+    main._redis.get.assert_awaited_once_with(main.exact_cache_key("test query"))
+    assert main.CACHE_STATS['exact_hit'] == 1
+
+
+@pytest.mark.asyncio
+async def test_exact_cache_miss_stores_response(exact_app, monkeypatch, mock_openwebui):
+    """Test that an uncached query is sent to the LLM and its answer stored with a TTL."""
+    monkeypatch.setattr(main, '_redis', mock_redis())
+
+    response = web.json_response({"choices": [{"message": {"content": "Fresh answer"}}]})
+    async with mock_openwebui(response):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+
+    assert result == "Fresh answer"
+    main._redis.set.assert_awaited_once_with(
+        main.exact_cache_key("Test query"), "Fresh answer", ex=14400
+    )
+    main._redis.execute_command.assert_not_awaited()
+    assert main.CACHE_STATS['exact_miss'] == 1
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_hit(semantic_app, vector, monkeypatch):
+    """Test that a similar cached query is answered without calling the LLM."""
+    monkeypatch.setattr(main, 'embed', AsyncMock(return_value=vector))
+    monkeypatch.setattr(main, '_redis', mock_redis([1, b'qa:67890:abc', [b'a', b'Cached answer', b'score', b'0.05']]))
+
+    with patch.object(main.aiohttp.ClientSession, 'post') as post:
+        result = await main.process_with_llm("Test query", 12345, 67890)
+    assert result == "Cached answer"
+    post.assert_not_called()
+
+    search = main._redis.execute_command.await_args_list[-1].args
+    assert search[0] == "FT.SEARCH"
+    assert search[2].startswith("(@chat:{67890})")
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_miss_stores_response(semantic_app, vector, monkeypatch, mock_openwebui):
+    """Test that a dissimilar cached query falls through to the LLM and is cached."""
+    monkeypatch.setattr(main, 'embed', AsyncMock(return_value=vector))
+    monkeypatch.setattr(main, '_redis', mock_redis([1, b'qa:67890:abc', [b'a', b'Other answer', b'score', b'0.5']]))
+    monkeypatch.setattr(main, 'semantic_cache_store', AsyncMock())
+
+    response = web.json_response({"choices": [{"message": {"content": "Fresh answer"}}]})
+    async with mock_openwebui(response):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+
+    assert result == "Fresh answer"
+    main.semantic_cache_store.assert_awaited_once_with("Test query", "Fresh answer", 67890, vector)
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_unavailable(semantic_app, monkeypatch, mock_openwebui):
+    """Test that cache failures fall back to the LLM without storing anything."""
+    monkeypatch.setattr(main, 'embed', AsyncMock(side_effect=aiohttp.ClientError("embedding service down")))
+    monkeypatch.setattr(main, 'semantic_cache_store', AsyncMock())
+
+    response = web.json_response({"choices": [{"message": {"content": "Fresh answer"}}]})
+    async with mock_openwebui(response):
+        result = await main.process_with_llm("Test query", 12345, 67890)
+
+    assert result == "Fresh answer"
+    main.semantic_cache_store.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_embed_does_not_send_openwebui_token(semantic_app, env, monkeypatch):
+    """Test that the OpenWebUI JWT is not sent to the embedding endpoint, but its own key is."""
+    auth_headers = []
+
+    async def embeddings(request):
+        auth_headers.append(request.headers.get('Authorization'))
+        return web.json_response({"data": [{"embedding": [0.6, 0.8]}]})
+
+    app = web.Application()
+    app.router.add_post('/api/embeddings', embeddings)
+    async with TestServer(app) as server:
+        endpoint = str(server.make_url('/api/embeddings'))
+        monkeypatch.setattr(main, 'CFG', dataclasses.replace(main.CFG, embedding_endpoint=endpoint))
+        assert await main.embed("Test query") == array('f', [0.6, 0.8]).tobytes()
+        await main.close_session()
+
+        main.build_app(env={**env, 'REDIS_URL': 'redis://localhost:6379/0',
+                            'EMBEDDING_ENDPOINT': endpoint, 'EMBEDDING_API_KEY': 'embed_key'})
+        await main.embed("Test query")
+        await main.close_session()
+
+    assert auth_headers == [None, "Bearer embed_key"]